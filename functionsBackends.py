@@ -0,0 +1,131 @@
+from numpy import *
+import functionsLB
+import functionsLBVectorised
+
+############################## Backend Registry #####################################
+
+# Kernels every backend has to provide
+backendKernels = ["macroscopic", "equilibrium", "macroscopicTPA", "equilibriumTPA",
+                  "addForces", "collide", "streamFluid", "streamTPA", "getKMask",
+                  "bindTPA", "dissolveClot", "liberateTPA"]
+
+# Registered backends, by name
+backends = {}
+
+# Register a backend from a module (or class) defining all the kernels
+def registerBackend(name, module):
+    missing = [kernel for kernel in backendKernels if not hasattr(module, kernel)]
+    if missing:
+        raise ValueError("Backend '" + name + "' is missing kernels : " + str(missing))
+
+    class Backend:
+        pass
+    Backend.name = name
+    for kernel in backendKernels:
+        setattr(Backend, kernel, getattr(module, kernel))
+
+    backends[name] = Backend
+    return Backend
+
+# Get a registered backend by name
+def getBackend(name):
+    if name not in backends:
+        raise ValueError("Unknown backend '" + name + "', available : " + str(list(backends)))
+    return backends[name]
+
+# Plain NumPy reference and vectorised CPU backend
+registerBackend("numpy", functionsLB)
+registerBackend("vectorised", functionsLBVectorised)
+
+############################## Time Step Functions ##################################
+
+# One fluid time step (collision, bounceback, forces, streaming)
+def fluidStep(backend, fin, fout, K, F, bounceback, openPath, lattice, fluid, d2q9):
+    # Compute macroscopic variables density and velocity.
+    rho, u = backend.macroscopic(fin, lattice, d2q9)
+
+    # Compute equilibrium.
+    feq = backend.equilibrium(rho, u, lattice, d2q9)
+
+    # Fluid BGK collision step for open path, bounce-back condition elsewhere
+    fout = backend.collide(fin, feq, fout, fluid.omega, bounceback)
+
+    # Forces (acceleration and clot resistance) application
+    fout += backend.addForces(rho, u, F, K, lattice, d2q9)
+
+    # Streaming step for fluid
+    fin = backend.streamFluid(fout, fin, d2q9)
+
+    return fin, fout, rho, u
+
+# One coupled fluid, tPA and clot time step
+def thrombolysisStep(backend, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                     F, bounceback, openPath, injection, lattice, fluid, clot, tpa, d2q9, d2q4):
+    # Compute macroscopic variables, density and velocity.
+    rho, u = backend.macroscopic(fin, lattice, d2q9)            # fluid
+    rhoTPA = backend.macroscopicTPA(tPAin)                      # tPA
+
+    # injecting tPA constantly
+    rhoTPA[injection] = fluid.rho_initial
+
+    # Compute equilibrium.
+    feq = backend.equilibrium(rho, u, lattice, d2q9)           # fluid
+    tPAeq = backend.equilibriumTPA(rhoTPA, u, lattice, d2q4)   # tPA
+
+    # Fluid BGK collision step for open path, bounce-back condition elsewhere
+    fout = backend.collide(fin, feq, fout, fluid.omega, bounceback)
+
+    # tPA BGK collision : only where there is no K, partial tPA bounceback on clot nodes
+    tPAout = backend.collide(tPAin, tPAeq, tPAout, fluid.omega, bounceback | KMask)
+
+    # Forces (acceleration and clot resistance) application
+    fout += backend.addForces(rho, u, F, K, lattice, d2q9)
+
+    # Streaming step for fluid and tPA
+    fin = backend.streamFluid(fout, fin, d2q9)
+    tPAin = backend.streamTPA(tPAout, tPAin, d2q4)
+
+    # Bind tPA to clot fribrin
+    tPABind, tPAin = backend.bindTPA(clot, tPAin, tPABind, KMask)
+
+    # Dissolve clot
+    K, tPABind = backend.dissolveClot(tPABind, K, tpa)
+    KMask = backend.getKMask(lattice, K)
+
+    # liberate remaining binded tPA for empty sites
+    tPABind = backend.liberateTPA(tPABind, KMask)
+
+    return fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA
+
+############################## Backend Cross-Check ##################################
+
+# Run the same steps on two backends and report the max deviation of every field.
+# The step function takes (backend, *state, *args) and returns the updated state
+# first, optionally followed by diagnostic fields. Names label all returned fields.
+def crossCheckBackends(reference, candidate, step, state, args, names, steps, tolerance):
+    nState = len(state)
+
+    # Independent copies so that neither run touches the caller's arrays
+    refOut = tuple(copy(a) for a in state)
+    candOut = tuple(copy(a) for a in state)
+
+    for _ in range(steps):
+        refOut = step(reference, *refOut[:nState], *args)
+        candOut = step(candidate, *candOut[:nState], *args)
+
+    # Max absolute deviation per field
+    deviations = {}
+    for name, refField, candField in zip(names, refOut, candOut):
+        diff = asarray(refField, dtype=float) - asarray(candField, dtype=float)
+        deviations[name] = float(amax(abs(diff))) if diff.size else 0.0
+
+    passed = all(array(list(deviations.values())) <= tolerance)
+
+    # Report
+    print("Backend cross-check : " + reference.name + " vs " + candidate.name
+          + " over " + str(steps) + " steps")
+    for name in deviations:
+        print("  max |d" + name + "| = " + str(deviations[name]))
+    print("  " + ("PASSED" if passed else "FAILED") + " (tolerance = " + str(tolerance) + ")")
+
+    return deviations, passed
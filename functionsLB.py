@@ -1,5 +1,4 @@
 from numpy import *
-from functionsMonitoring import saveKValues
 
 #################### Main Function Definitions ######################################
 
@@ -43,6 +42,38 @@ def addForces(rho, u, F, K, lattice, d2q9):
         FF[i,:,:] = FF[i,:,:] * (d2q9.w[i] / d2q9.cs2)
     return FF
 
+# BGK collision outside the solid nodes, full bounce-back on the solid nodes
+def collide(fin, feq, fout, omega, solid):
+    fluidNodes = invert(solid)
+    fout[:,fluidNodes] = fin[:,fluidNodes] - omega * (fin[:,fluidNodes] - feq[:,fluidNodes])
+
+    # Bounce-back : opposite direction is q-1-i for D2Q9 and D2Q4
+    q = fin.shape[0]
+    for i in range(q):
+        fout[i, solid] = fin[q-1-i, solid]
+    return fout
+
+# Streaming step for fluid in every direction i=0:8
+def streamFluid(fout, fin, d2q9):
+    fin[0,:,:] = roll(roll(fout[0,:,:],1,axis=0),1,axis=1)      # i = 0
+    fin[1,:,:] = roll(fout[1,:,:],1,axis=0)                     # i = 1
+    fin[2,:,:] = roll(roll(fout[2,:,:],1,axis=0),-1,axis=1)     # i = 2
+    fin[3,:,:] = roll(fout[3,:,:],1,axis=1)                     # i = 3
+    fin[4,:,:] = fout[4,:,:]                                    # i = 4
+    fin[5,:,:] = roll(fout[5,:,:],-1,axis=1)                    # i = 5
+    fin[6,:,:] = roll(roll(fout[6,:,:],-1,axis=0),1,axis=1)     # i = 6
+    fin[7,:,:] = roll(fout[7,:,:],-1,axis=0)                    # i = 7
+    fin[8,:,:] = roll(roll(fout[8,:,:],-1,axis=0),-1,axis=1)    # i = 8
+    return fin
+
+# Streaming step for tPA in every direction i=0:4
+def streamTPA(tPAout, tPAin, d2q4):
+    tPAin[0,:,:] = roll(tPAout[0,:,:],1,axis=0)                 # i = 0
+    tPAin[1,:,:] = roll(tPAout[1,:,:],1,axis=1)                 # i = 1
+    tPAin[2,:,:] = roll(tPAout[2,:,:],-1,axis=1)                # i = 2
+    tPAin[3,:,:] = roll(tPAout[3,:,:],-1,axis=0)                # i = 3
+    return tPAin
+
 # Mask of clot sites
 def getKMask(lattice, K):
     # Initialise mask
@@ -134,6 +165,12 @@ def generateAccFieldMask(lattice):
     pulseField[1:lattice.tubeSize+1,(lattice.ny//2-10):(lattice.ny//2+11)] = True
     return pulseField
 
+# tPA injection mask
+def generateInjectionMask(lattice):
+    injection = full((lattice.nx, lattice.ny),False)
+    injection[1:lattice.tubeSize+1, lattice.ny//2] = True
+    return injection
+
 # Initial Clot mask
 def generateClotMask(lattice, clot):
     clotMask = full((lattice.nx, lattice.ny),False)
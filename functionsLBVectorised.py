@@ -0,0 +1,105 @@
+from numpy import *
+
+# Vectorised versions of the kernels in functionsLB.py. Same signatures and
+# same results (up to round-off), with float velocity vectors, in-place updates
+# and as few full-size temporaries as possible.
+
+#################### Main Function Definitions ######################################
+
+# Macroscopic variables
+def macroscopic(fin, lattice, d2q9):
+    rho = sum(fin, axis=0)
+    u = tensordot(d2q9.v.transpose(), fin, axes=1)
+    u /= rho
+    return rho, u
+
+# Fluid equilibrium distribution function, built in place direction by direction
+def equilibrium(rho, u, lattice, d2q9):
+    v = 3 * d2q9.v.astype(float)
+    usqr = 1 - 3/2 * (u[0]*u[0] + u[1]*u[1])
+    feq = empty((9,) + rho.shape)
+    cu = empty(rho.shape)
+    for i in range(9):
+        multiply(u[0], v[i,0], out=cu)
+        cu += v[i,1]*u[1]
+        multiply(cu, cu, out=feq[i])
+        feq[i] *= 0.5
+        feq[i] += cu
+        feq[i] += usqr
+        feq[i] *= rho
+        feq[i] *= d2q9.w[i]
+    return feq
+
+# Macroscopic variable for tPA (only rho)
+def macroscopicTPA(tPAin):
+    rhoTPA = sum(tPAin, axis=0)
+    return rhoTPA
+
+# tPA Equilibrium distribution function
+def equilibriumTPA(rhoTPA, u, lattice, d2q4):
+    vu = tensordot(d2q4.v, u, axes=1)
+    tPAeq = d2q4.w[:,newaxis,newaxis] * rhoTPA * (1 + (1/d2q4.cs2)*vu)
+    return tPAeq
+
+# Acceleration force and porous region resistance
+def addForces(rho, u, F, K, lattice, d2q9):
+    # rho * (F - K*u), then projected on the weighted directions
+    G = K*u
+    subtract(F, G, out=G)
+    G *= rho
+    FF = tensordot(d2q9.v * (d2q9.w / d2q9.cs2)[:,newaxis], G, axes=1)
+    return FF
+
+# BGK collision on the full array, then bounce-back copied in on the solid nodes
+# (reversing the direction axis gives the opposite directions)
+def collide(fin, feq, fout, omega, solid):
+    subtract(fin, feq, out=fout)
+    fout *= -omega
+    fout += fin
+    copyto(fout, fin[::-1], where=solid)
+    return fout
+
+# Streaming step for fluid : one roll per direction along its velocity vector
+def streamFluid(fout, fin, d2q9):
+    for i in range(9):
+        fin[i,:,:] = roll(fout[i,:,:], tuple(d2q9.v[i]), axis=(0,1))
+    return fin
+
+# Streaming step for tPA : one roll per direction along its velocity vector
+def streamTPA(tPAout, tPAin, d2q4):
+    for i in range(4):
+        tPAin[i,:,:] = roll(tPAout[i,:,:], tuple(d2q4.v[i]), axis=(0,1))
+    return tPAin
+
+# Mask of clot sites
+def getKMask(lattice, K):
+    KMask = K[0] != 0
+    return KMask
+
+# Binding tPA to fibrin with a gamma factor
+def bindTPA(clot, tPAin, tPABind, KMask):
+    # Get binded tPA portion
+    tPABind[:,KMask] += clot.gamma*tPAin[:,KMask]
+
+    # Calculate remaining free tPA
+    tPAin -= tPABind
+
+    return tPABind, tPAin
+
+def dissolveClot(tPABind, K, tPA):
+    # Dissolution amount (considering isotropic clot)
+    dissolutionAmount = abs(sum(tPABind, axis=0)*tPA.r*K[0,:,:])
+
+    # Dissolve both components at once, values below 1e-7 are set to 0
+    K_tmp = K - dissolutionAmount
+    K[:] = where(K_tmp > 1e-7, K_tmp, 0)
+
+    # Update tPABind quantities
+    tPABind -= tPABind*tPA.r
+
+    return K, tPABind
+
+# Removing binded tPA where the clot has been dissolved
+def liberateTPA(tPABind, KMask):
+    tPABind *= KMask
+    return tPABind
@@ -62,6 +62,7 @@ def createRepositoriesThrombolysis(lattice, fluid, clot, tpa, Dir):
     mainDirTmp += "_g=" + str(clot.gamma)
     mainDirTmp += "_F=" + str(fluid.F_initial) + "_K=" + str(clot.K_initial)
     mainDirTmp += "_it=" + str(lattice.maxIter)
+    mainDirTmp += Dir.tag
 
     if not os.path.exists(mainDirTmp):
         os.mkdir(mainDirTmp)
@@ -219,5 +220,20 @@ def saveValues(Directory, file, headerX, headerY, values, iterations):
 
     print(f"Data has been saved to '{file_name}'.")
 
+# Reading a csv file generated by saveValues
+def loadValues(Directory, file):
+    iterations = []
+    values = []
 
+    file_name = Directory + file
+    with open(file_name, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+
+        # Skip the header
+        next(reader)
+
+        for row in reader:
+            iterations.append(float(row[0]))
+            values.append(float(row[1]))
 
+    return iterations, values
@@ -0,0 +1,204 @@
+from numpy import *
+import multiprocessing as mp
+from threading import BrokenBarrierError
+from functionsBackends import backendKernels, thrombolysisStep
+
+# Domain decomposition of the thrombolysis run over several processes.
+# The domain is cut in strips along x, each strip is updated by its own process
+# with one halo column on each side. Halo populations are exchanged through
+# shared-memory buffers before streaming, the clot state and the diagnostics
+# are gathered by the main process. Each exchange only talks to the left and
+# right neighbours, so the same layout maps onto MPI sendrecv calls.
+
+############################## Domain Partitioning ##################################
+
+# Split the domain in strips along x, balanced by the number of fluid nodes
+def partitionDomain(openPath, nSub):
+    nx = openPath.shape[0]
+
+    # Cumulative number of fluid nodes per column
+    cumulative = cumsum(count_nonzero(openPath, axis=1))
+
+    # Cut after the column where each share of fluid nodes is reached
+    targets = cumulative[-1] * arange(1, nSub) / nSub
+    bounds = concatenate(([0], searchsorted(cumulative, targets) + 1, [nx]))
+
+    # Every strip needs at least one column
+    for i in range(1, nSub):
+        bounds[i] = clip(bounds[i], bounds[i-1] + 1, nx - (nSub - i))
+
+    return [(int(bounds[i]), int(bounds[i+1])) for i in range(nSub)]
+
+# Strip of a global field with one (periodic) halo column on each side
+def getSubdomain(field, x0, x1, nx):
+    columns = arange(x0 - 1, x1 + 1) % nx
+    return field[..., columns, :].copy()
+
+############################## Shared Memory ########################################
+
+# Numpy view on a shared-memory buffer (inherited by forked processes)
+def sharedArray(shape):
+    buffer = mp.RawArray('d', int(prod(shape)))
+    return frombuffer(buffer, dtype=float64).reshape(shape)
+
+# Exchanging the edge columns of a population with the neighbouring strips.
+# Buffers are doubled and alternate between exchanges, so a single barrier is
+# enough: a strip can only write a buffer again once all strips have read it.
+def exchangeHalo(pop, halo, exchange, rank, nSub, barrier):
+    parity = exchange % 2
+
+    # Send own edge columns
+    halo[parity, rank, 0] = pop[:,1,:]
+    halo[parity, rank, 1] = pop[:,-2,:]
+    barrier.wait()
+
+    # Receive neighbours edge columns in the halo columns
+    pop[:,0,:] = halo[parity, (rank-1) % nSub, 1]
+    pop[:,-1,:] = halo[parity, (rank+1) % nSub, 0]
+
+# Backend doing the halo exchange before streaming
+def makeHaloBackend(backend, shared, rank, nSub, barrier):
+    class HaloBackend:
+        name = backend.name + "+halo"
+        fluidExchanges = 0
+        tPAExchanges = 0
+    for kernel in backendKernels:
+        setattr(HaloBackend, kernel, getattr(backend, kernel))
+
+    def streamFluid(fout, fin, d2q9):
+        exchangeHalo(fout, shared.haloFluid, HaloBackend.fluidExchanges, rank, nSub, barrier)
+        HaloBackend.fluidExchanges += 1
+        return backend.streamFluid(fout, fin, d2q9)
+
+    def streamTPA(tPAout, tPAin, d2q4):
+        exchangeHalo(tPAout, shared.haloTPA, HaloBackend.tPAExchanges, rank, nSub, barrier)
+        HaloBackend.tPAExchanges += 1
+        return backend.streamTPA(tPAout, tPAin, d2q4)
+
+    HaloBackend.streamFluid = streamFluid
+    HaloBackend.streamTPA = streamTPA
+
+    return HaloBackend
+
+############################## Subdomain Process ####################################
+
+# Time loop of one strip
+def subdomainWorker(rank, nSub, x0, x1, backend, shared, workerBarrier, gatherBarrier,
+                    fin, fout, tPAin, tPAout, tPABind, K, F, bounceback, openPath, injection,
+                    lattice, fluid, clot, tpa, d2q9, d2q4, gatherEvery):
+    try:
+        # Local lattice of the strip, with its halo columns
+        class LocalLattice(lattice):
+            nx = x1 - x0 + 2
+
+        sub = lambda field: getSubdomain(field, x0, x1, lattice.nx)
+        fin, fout, tPAin, tPAout, tPABind, K = sub(fin), sub(fout), sub(tPAin), sub(tPAout), sub(tPABind), sub(K)
+        F, bounceback, openPath, injection = sub(F), sub(bounceback), sub(openPath), sub(injection)
+        KMask = backend.getKMask(LocalLattice, K)
+
+        haloBackend = makeHaloBackend(backend, shared, rank, nSub, workerBarrier)
+        interior = slice(1, -1)
+
+        for execTime in range(lattice.maxIter):
+            fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA = thrombolysisStep(
+                haloBackend, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                F, bounceback, openPath, injection, LocalLattice, fluid, clot, tpa, d2q9, d2q4)
+
+            if execTime % gatherEvery == 0:
+                # Gather clot state
+                shared.K[:,x0:x1] = K[:,interior]
+                shared.tPABind[:,x0:x1] = tPABind[:,interior]
+
+                # Partial sums for the reductions
+                openInterior = openPath[interior]
+                shared.partial[rank] = [sum(rho[interior][openInterior]),
+                                        sum(tPAin[:,interior][:,openInterior]),
+                                        sum(K[0,interior]),
+                                        sum(tPABind[:,interior])]
+
+                # Main process reduces, then decides if the run stops
+                gatherBarrier.wait()
+                gatherBarrier.wait()
+                if shared.stop[0]:
+                    break
+
+        # Final state of the strip
+        shared.fin[:,x0:x1] = fin[:,interior]
+        shared.fout[:,x0:x1] = fout[:,interior]
+        shared.tPAin[:,x0:x1] = tPAin[:,interior]
+        shared.tPAout[:,x0:x1] = tPAout[:,interior]
+        shared.tPABind[:,x0:x1] = tPABind[:,interior]
+        shared.K[:,x0:x1] = K[:,interior]
+
+    except BaseException:
+        # Release every other process waiting on a barrier
+        workerBarrier.abort()
+        gatherBarrier.abort()
+        raise
+
+############################## Decomposed Run #######################################
+
+# Thrombolysis run decomposed over nSub processes. onGather(execTime, K, tPABind,
+# diagnostics) is called by the main process every gatherEvery iterations with the
+# gathered clot state and the reduced diagnostics (fluid mass, free tPA, remaining
+# K, binded tPA), and returns a stopping reason or None to keep going.
+def runDecomposed(nSub, backend, fin, fout, tPAin, tPAout, tPABind, K, F, bounceback, openPath,
+                  injection, lattice, fluid, clot, tpa, d2q9, d2q4, gatherEvery, onGather):
+    # Shared-memory buffers
+    fluidShape, tPAShape, KShape = fin.shape, tPAin.shape, K.shape
+    class Shared:
+        haloFluid = sharedArray((2, nSub, 2, 9, lattice.ny))
+        haloTPA = sharedArray((2, nSub, 2, 4, lattice.ny))
+        partial = sharedArray((nSub, 4))
+        stop = sharedArray((1,))
+        fin = sharedArray(fluidShape)
+        fout = sharedArray(fluidShape)
+        tPAin = sharedArray(tPAShape)
+        tPAout = sharedArray(tPAShape)
+        tPABind = sharedArray(tPAShape)
+        K = sharedArray(KShape)
+
+    # Strips balanced by fluid nodes
+    subdomains = partitionDomain(openPath, nSub)
+    print("Subdomains (x ranges) : " + str(subdomains))
+
+    # Forked processes inherit the shared buffers and the initial fields
+    context = mp.get_context("fork")
+    workerBarrier = context.Barrier(nSub)
+    gatherBarrier = context.Barrier(nSub + 1)
+
+    processes = []
+    for rank, (x0, x1) in enumerate(subdomains):
+        process = context.Process(target=subdomainWorker,
+                                  args=(rank, nSub, x0, x1, backend, Shared, workerBarrier, gatherBarrier,
+                                        fin, fout, tPAin, tPAout, tPABind, K, F, bounceback, openPath, injection,
+                                        lattice, fluid, clot, tpa, d2q9, d2q4, gatherEvery))
+        process.start()
+        processes.append(process)
+
+    # Reductions and stop decision at every gather
+    reason = None
+    lastIter = lattice.maxIter - 1
+    try:
+        for execTime in range(0, lattice.maxIter, gatherEvery):
+            gatherBarrier.wait()
+            diagnostics = sum(Shared.partial, axis=0)
+            reason = onGather(execTime, Shared.K, Shared.tPABind, diagnostics)
+            Shared.stop[0] = reason is not None
+            gatherBarrier.wait()
+            if reason is not None:
+                lastIter = execTime
+                break
+    except BrokenBarrierError:
+        raise RuntimeError("A subdomain process failed, see its traceback above")
+    except BaseException:
+        # Release the subdomain processes before leaving
+        workerBarrier.abort()
+        gatherBarrier.abort()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+
+    return (copy(Shared.fin), copy(Shared.fout), copy(Shared.tPAin), copy(Shared.tPAout),
+            copy(Shared.tPABind), copy(Shared.K), lastIter, reason)
@@ -0,0 +1,208 @@
+from numpy import *
+from functionsBackends import thrombolysisStep
+
+# Projective integration of the clot dissolution. K and the binded tPA change
+# slowly compared to the fluid and tPA populations. Each cycle runs a burst of
+# fully coupled steps: the first healSteps let the fast fields re-equilibrate
+# with the clot, the remaining ones give the rates of change of K, tPABind and
+# free tPA. The state is then extrapolated by a projection step. As dissolveClot
+# removes a proportion of K at each step, K is extrapolated with its logarithmic
+# rate. The step is adapted to the extrapolation error of global totals (clot
+# resistance, binded tPA) rather than node by node: nodes at the front keep
+# switching from no dissolution to a fast one, which says little about the error
+# on the clot as a whole. With projectTPA, the filling of the loop with tPA is
+# projected too, before the clot starts dissolving.
+
+############################## Projection Step ######################################
+
+# Logarithmic dissolution rate of K, on the nodes still holding clot
+def getKLogRate(KStart, KEnd, steps):
+    clotLeft = (KStart[0] > 0) & (KEnd[0] > 0)
+    KLogRate = zeros(KStart.shape[1:])
+    KLogRate[clotLeft] = log(KEnd[0,clotLeft] / KStart[0,clotLeft]) / steps
+    return KLogRate
+
+# Totals the projection error is measured on : clot resistance, and binded tPA
+# (the tPA that reached the clot and drives the dissolution)
+def getSlowTotals(K, tPABind):
+    return array([sum(K[0]), sum(tPABind)])
+
+# Projection step from the change of the rates of the global totals between two
+# bursts. Extrapolating a total over the step errs by about 0.5 * step^2 *
+# |d(rate)/dt|, kept below tolerance times its scale (initial clot resistance,
+# current binded tPA), and its rate should not change by more than rateTolerance
+# over the step. Totals that do not change are left out.
+def getProjectionStep(rates, previousRates, elapsed, previousStep, scales, projective):
+    changing = rates != 0
+    if not any(changing):
+        return 0
+
+    if previousRates is None:
+        step = projective.initialProjection
+    else:
+        variation = abs(rates - previousRates)[changing] / elapsed
+        variation = where(variation > 0, variation, 1e-300)
+        step = amin(minimum(sqrt(2 * projective.tolerance * abs(scales[changing]) / variation),
+                            projective.rateTolerance * abs(rates[changing]) / variation))
+
+        # Grow the step progressively
+        step = minimum(step, 2 * maximum(previousStep, 1))
+
+    return int(clip(step, projective.minProjection, projective.maxProjection))
+
+# Extrapolating the clot state over the projection step. Each node decays with
+# its log rate. Along each lane of the clot (nodes along x at a fixed y), a node
+# reaching the dissolveClot threshold hands the rest of the step over to the next
+# node, which tPA only reaches then, with the same log rate : the front keeps
+# moving during the projection.
+def projectClot(backend, K, tPABind, KLogRate, bindRate, step, clotMask, lattice):
+    K = copy(K)
+    rows, cols = where(clotMask)
+    lanes = slice(cols.min(), cols.max() + 1)
+
+    carried = zeros(lanes.stop - lanes.start)    # Log rate handed over by a dissolved node
+    left = zeros(lanes.stop - lanes.start)       # Projection time left for it
+    for x in range(rows.min(), rows.max() + 1):
+        # Own log rate for the nodes already dissolving, handed over one otherwise
+        ownRate = KLogRate[x,lanes] < 0
+        rate = where(ownRate, KLogRate[x,lanes], carried)
+        time = where(ownRate, step, left)
+        active = (K[0,x,lanes] > 0) & (rate < 0)
+
+        # Time to the threshold, and decay over the time available
+        extinction = full(rate.shape, inf)
+        extinction[active] = log(1e-7 / K[0,x,lanes][active]) / rate[active]
+        dissolved = active & (extinction <= time)
+        factor = where(active, exp(rate*time), 1)
+        factor[dissolved] = 0
+        K[:,x,lanes] *= factor
+
+        carried = where(dissolved, rate, 0)
+        left = where(dissolved, time - extinction, 0)
+
+    tPABind = tPABind + step*bindRate
+
+    # Same threshold as dissolveClot, no negative binded tPA
+    K = where(K > 1e-7, K, 0)
+    tPABind = where(tPABind > 0, tPABind, 0)
+
+    KMask = backend.getKMask(lattice, K)
+    tPABind = backend.liberateTPA(tPABind, KMask)
+
+    return K, tPABind, KMask
+
+############################## Projective Run #######################################
+
+# Thrombolysis run with projective integration of the clot. onCycle(execTime, K,
+# tPABind, diagnostics) is called after every projection with the simulated
+# iteration, and returns a stopping reason or None to keep going.
+def runProjective(backend, fin, fout, tPAin, tPAout, tPABind, K, KMask, F, bounceback, openPath,
+                  injection, lattice, fluid, clot, tpa, d2q9, d2q4, projective, onCycle):
+    execTime = 0
+    computedSteps = 0
+    previousRates = None
+    previousTime = 0
+    previousStep = 0
+    reason = None
+
+    # Clot nodes, and scale of the clot resistance error
+    clotMask = K[0] > 0
+    KTotal = sum(K[0])
+
+    while execTime < lattice.maxIter:
+        # Burst of fully coupled steps, without going past maxIter
+        burstSteps = int(minimum(projective.burstSteps, lattice.maxIter - execTime))
+        for burstStep in range(burstSteps):
+            fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA = thrombolysisStep(
+                backend, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                F, bounceback, openPath, injection, lattice, fluid, clot, tpa, d2q9, d2q4)
+
+            # Fast fields re-equilibrated : start measuring the slow rates
+            if burstStep == projective.healSteps - 1:
+                KStart = copy(K)
+                bindStart = copy(tPABind)
+                tPAStart = copy(tPAin)
+
+        execTime += burstSteps
+        computedSteps += burstSteps
+
+        # Projection after complete bursts only, a shortened one reached maxIter
+        step = 0
+        if execTime < lattice.maxIter:
+            # Rates of change over the end of the burst
+            measuredSteps = burstSteps - projective.healSteps
+            KLogRate = getKLogRate(KStart, K, measuredSteps)
+            bindRate = (tPABind - bindStart) / measuredSteps
+            tPARate = (tPAin - tPAStart) / measuredSteps
+
+            # Rates of the global totals, binded tPA only when tPA is projected
+            totals = getSlowTotals(K, tPABind)
+            rates = (totals - getSlowTotals(KStart, bindStart)) / measuredSteps
+            if not projective.projectTPA:
+                rates[1] = 0
+
+            # Adaptive projection step, without going past maxIter
+            step = getProjectionStep(rates, previousRates, execTime - previousTime, previousStep,
+                                     array([KTotal, totals[1]]), projective)
+            step = int(clip(step, 0, lattice.maxIter - execTime))
+            previousRates, previousTime, previousStep = rates, execTime, step
+
+            K, tPABind, KMask = projectClot(backend, K, tPABind, KLogRate, bindRate, step, clotMask, lattice)
+
+            # Free tPA keeps accumulating in the loop, its slow drift is projected too
+            if projective.projectTPA:
+                tPAin = tPAin + step*tPARate
+                tPAin = where(tPAin > 0, tPAin, 0)
+
+        execTime += step
+
+        # Last iteration done, numbered from 0 as in the standard run
+        reason = onCycle(execTime - 1, K, tPABind, [step, computedSteps])
+        if reason is not None:
+            break
+
+    print("Projective integration : " + str(execTime) + " simulated iterations for "
+          + str(computedSteps) + " computed (x" + str(round(execTime / computedSteps, 2)) + ")")
+
+    return fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, execTime - 1, reason
+
+############################## Front Agreement ######################################
+
+# First iteration at which the clot is fully dissolved : getFrontIndex is back to
+# 0 after the front moved (None if it never happens)
+def getDissolutionIteration(iterations, fronts):
+    moved = False
+    for iteration, front in zip(iterations, fronts):
+        if front > 0:
+            moved = True
+        elif moved:
+            return iteration
+    return None
+
+# Deviation of a clot front from a reference (standard) run, interpolated on the
+# reference iterations covered by both runs, up to the first full dissolution in
+# either run (the front index drops back to 0 there). The dissolution iterations
+# are reported separately.
+def compareClotFronts(iterations, fronts, refIterations, refFronts):
+    iterations = asarray(iterations, dtype=float)
+    fronts = asarray(fronts, dtype=float)
+    refIterations = asarray(refIterations, dtype=float)
+    refFronts = asarray(refFronts, dtype=float)
+
+    dissolved = getDissolutionIteration(iterations, fronts)
+    refDissolved = getDissolutionIteration(refIterations, refFronts)
+
+    # Up to the end of the run, and before any full dissolution
+    end = amax(iterations)
+    dissolutions = [it for it in (dissolved, refDissolved) if it is not None]
+    if dissolutions:
+        end = minimum(end, amin(dissolutions) - 1)
+    before = iterations <= end
+    covered = refIterations <= end
+    deviation = interp(refIterations[covered], iterations[before], fronts[before]) - refFronts[covered]
+
+    print("Clot front deviation from reference : max = " + str(amax(abs(deviation)))
+          + ", mean = " + str(mean(abs(deviation))))
+    print("Full dissolution : iteration " + str(dissolved) + ", reference " + str(refDissolved))
+
+    return refIterations[covered], deviation
@@ -0,0 +1,259 @@
+from numpy import *
+from functionsMonitoring import getFrontIndex
+from functionsBackends import thrombolysisStep
+
+# Local grid refinement around the clot. A fine patch (dx/n, dt/n) covers the
+# clot and a margin around it, and overlaps the coarse lattice that keeps running
+# everywhere. Each coarse step, the fine patch does n substeps with its outer ring
+# of nodes set from the coarse populations (interpolated in space and time), then
+# the coarse nodes inside the patch are overwritten by the fine ones. The non
+# equilibrium part of the populations is rescaled at the interface (Dupuis &
+# Chopard, 2003). The clot reaction and the clot front are computed on the patch.
+
+############################## Grid Transfer ########################################
+
+# Linear interpolation of a coarse field (..., nx, ny) on the fine nodes
+def prolongLinear(field, n):
+    nxc, nyc = field.shape[-2:]
+
+    # Fine node positions in coarse units, and their left coarse neighbour
+    x = arange(n*(nxc-1)+1) / n
+    y = arange(n*(nyc-1)+1) / n
+    x0 = minimum(floor(x).astype(int), nxc-2)
+    y0 = minimum(floor(y).astype(int), nyc-2)
+    fx = (x - x0)[:,newaxis]
+    fy = y - y0
+
+    # Interpolate along x, then along y
+    fine = field[...,x0,:]*(1-fx) + field[...,x0+1,:]*fx
+    fine = fine[...,y0]*(1-fy) + fine[...,y0+1]*fy
+
+    return fine
+
+# Nearest coarse node value on the fine nodes (masks, clot fields). Used for the
+# walls, the fine bounceback nodes keep the coarse channel widths : the wall is
+# at the same place for odd n, and shifted by 1/(2n) coarse node for even n
+def prolongNearest(field, n):
+    nxc, nyc = field.shape[-2:]
+    xNearest = (arange(n*(nxc-1)+1) + n//2) // n
+    yNearest = (arange(n*(nyc-1)+1) + n//2) // n
+    return field[...,xNearest,:][...,yNearest]
+
+# Linear interpolation of a coarse field using only the coarse nodes in mask
+def prolongMasked(field, mask, n):
+    weights = prolongLinear(mask.astype(float), n)
+    return prolongLinear(where(mask, field, 0), n) / where(weights > 0, weights, 1)
+
+# Populations on the fine nodes : fluid nodes are interpolated from fluid coarse
+# nodes only, solid nodes from solid ones
+def prolongPopulations(field, bounceback, fineBounceback, n):
+    return where(fineBounceback, prolongMasked(field, bounceback, n),
+                 prolongMasked(field, invert(bounceback), n))
+
+# Mean of the fine block of each inner coarse node, i.e. the fine nodes that
+# prolongNearest maps to it (clot fields). The clot stays inside its coarse nodes
+# and restrictBlock(prolongNearest(field)) == field.
+def restrictBlock(field, n):
+    nxf, nyf = field.shape[-2:]
+    nxc, nyc = (nxf-1)//n - 1, (nyf-1)//n - 1
+    start = n - n//2
+    cells = field[...,start:start+n*nxc,start:start+n*nyc]
+    cells = cells.reshape(field.shape[:-2] + (nxc, n, nyc, n))
+    return cells.mean(axis=(-3,-1))
+
+# Weighted mean of the fine nodes around each inner coarse node (smooth fields),
+# centred on the coincident fine node with the linear interpolation weights
+# (n - |k|) / n per axis, i.e. 1/4, 1/2, 1/4 for n = 2
+def restrictMean(field, n):
+    nxf, nyf = field.shape[-2:]
+    nxc, nyc = (nxf-1)//n - 1, (nyf-1)//n - 1
+    offsets = arange(1-n, n)
+    weights = (n - abs(offsets)) / n**2
+
+    # Along x, then along y
+    coarse = sum([w * field[...,n+k:n+k+n*nxc:n,:] for k, w in zip(offsets, weights)], axis=0)
+    coarse = sum([w * coarse[...,n+k:n+k+n*nyc:n] for k, w in zip(offsets, weights)], axis=0)
+
+    return coarse
+
+# Rescaling the non equilibrium part of fluid and tPA populations by alpha
+def rescalePopulations(backend, fin, tPAin, lattice, d2q9, d2q4, alpha):
+    rho, u = backend.macroscopic(fin, lattice, d2q9)
+    feq = backend.equilibrium(rho, u, lattice, d2q9)
+
+    rhoTPA = backend.macroscopicTPA(tPAin)
+    tPAeq = backend.equilibriumTPA(rhoTPA, u, lattice, d2q4)
+
+    return feq + alpha*(fin - feq), tPAeq + alpha*(tPAin - tPAeq)
+
+############################## Refined Patch ########################################
+
+# Building the fine patch around the clot, from the current coarse state
+def initRefinement(backend, n, margin, fin, tPAin, tPABind, K, F, bounceback, injection, clotMask,
+                   lattice, fluid, clot, tpa, d2q9, d2q4):
+    # Patch corners (coarse nodes, inclusive) : clot bounding box plus margin
+    rows, cols = where(clotMask)
+    x0, x1 = int(clip(rows.min() - margin, 0, lattice.nx - 1)), int(clip(rows.max() + margin, 0, lattice.nx - 1))
+    y0, y1 = int(clip(cols.min() - margin, 0, lattice.ny - 1)), int(clip(cols.max() + margin, 0, lattice.ny - 1))
+    region = (slice(x0, x1+1), slice(y0, y1+1))
+    inner = (slice(x0+1, x1), slice(y0+1, y1))
+
+    # Same viscosity and diffusion with dt/n and dx/n
+    omegaFine = 1 / (n*(1/fluid.omega - 0.5) + 0.5)
+    fineShape = (n*(x1-x0)+1, n*(y1-y0)+1)
+
+    class FineLattice(lattice):
+        nx, ny = fineShape
+
+    class FineFluid(fluid):
+        omega = omegaFine
+
+    # Forces and clot resistance per fine step, binding and reaction such that
+    # the proportions over one coarse step are unchanged
+    class FineClot(clot):
+        K_initial = [k/n for k in clot.K_initial]
+        gamma = 1 - (1 - clot.gamma)**(1/n)
+
+    class FineTPA(tpa):
+        r = 1 - (1 - tpa.r)**(1/n)
+
+    # Outer ring of fine nodes, set from the coarse lattice
+    ring = full(fineShape, True)
+    ring[1:-1,1:-1] = False
+
+    # Rescaling factor of the non equilibrium populations, tau_f / (n tau_c)
+    alpha = (1/omegaFine) / (n/fluid.omega)
+
+    class Patch:
+        factor = n
+        lattice = FineLattice
+        fluid = FineFluid
+        clot = FineClot
+        tpa = FineTPA
+        alphaToFine = alpha
+        alphaToCoarse = 1/alpha
+
+    Patch.region = region
+    Patch.inner = inner
+    Patch.ring = ring
+
+    # Fine masks and fields
+    Patch.coarseBounceback = bounceback[region]
+    Patch.bounceback = prolongNearest(Patch.coarseBounceback, n)
+    Patch.openPath = invert(Patch.bounceback)
+    Patch.injection = prolongNearest(injection[region], n)
+    Patch.clotMask = prolongNearest(clotMask[region], n)
+    Patch.F = prolongNearest(F[(slice(None),)+region], n) / n
+    Patch.K = prolongNearest(K[(slice(None),)+region], n) / n
+    Patch.KMask = backend.getKMask(FineLattice, Patch.K)
+    Patch.tPABind = prolongNearest(tPABind[(slice(None),)+region], n)
+
+    # Fine populations
+    prolong = lambda pop: prolongPopulations(pop[(slice(None),)+region], Patch.coarseBounceback, Patch.bounceback, n)
+    Patch.fin, Patch.tPAin = rescalePopulations(backend, prolong(fin), prolong(tPAin),
+                                                FineLattice, d2q9, d2q4, Patch.alphaToFine)
+    Patch.fout = copy(Patch.fin)
+    Patch.tPAout = copy(Patch.tPAin)
+
+    print("Refined patch : x = " + str([x0, x1]) + ", y = " + str([y0, y1])
+          + ", factor = " + str(n) + ", fine nodes = " + str(fineShape))
+
+    return Patch
+
+# Coarse thrombolysis step followed by the fine substeps and the restriction
+def refinedThrombolysisStep(backend, patch, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                            F, bounceback, openPath, injection, lattice, fluid, clot, tpa, d2q9, d2q4):
+    n = patch.factor
+    region = (slice(None),) + patch.region
+    inner = (slice(None),) + patch.inner
+
+    # Coarse populations at the start of the step
+    finStart = copy(fin[region])
+    tPAinStart = copy(tPAin[region])
+
+    # Coarse step
+    fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA = thrombolysisStep(
+        backend, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+        F, bounceback, openPath, injection, lattice, fluid, clot, tpa, d2q9, d2q4)
+
+    # Coarse populations at the start and end of the step, on the fine nodes
+    prolong = lambda pop: prolongPopulations(pop, patch.coarseBounceback, patch.bounceback, n)
+    finStart, tPAinStart = rescalePopulations(backend, prolong(finStart), prolong(tPAinStart),
+                                              patch.lattice, d2q9, d2q4, patch.alphaToFine)
+    finEnd, tPAinEnd = rescalePopulations(backend, prolong(fin[region]), prolong(tPAin[region]),
+                                          patch.lattice, d2q9, d2q4, patch.alphaToFine)
+
+    # Fine substeps, with the ring interpolated in time
+    ring = patch.ring
+    for s in range(n):
+        a = s / n
+        patch.fin[:,ring] = (1-a)*finStart[:,ring] + a*finEnd[:,ring]
+        patch.tPAin[:,ring] = (1-a)*tPAinStart[:,ring] + a*tPAinEnd[:,ring]
+
+        (patch.fin, patch.fout, patch.tPAin, patch.tPAout, patch.tPABind,
+         patch.K, patch.KMask, _, _, _) = thrombolysisStep(
+            backend, patch.fin, patch.fout, patch.tPAin, patch.tPAout, patch.tPABind, patch.K, patch.KMask,
+            patch.F, patch.bounceback, patch.openPath, patch.injection,
+            patch.lattice, patch.fluid, patch.clot, patch.tpa, d2q9, d2q4)
+
+    # Restriction : coarse nodes inside the patch take the coincident fine populations
+    # and the mean of their fine block for the clot fields
+    coincident = (slice(None), slice(n, -n, n), slice(n, -n, n))
+
+    class InnerLattice(lattice):
+        nx, ny = fin[inner].shape[1:]
+
+    fin[inner], tPAin[inner] = rescalePopulations(backend, patch.fin[coincident], patch.tPAin[coincident],
+                                                  InnerLattice, d2q9, d2q4, patch.alphaToCoarse)
+    K[inner] = restrictBlock(patch.K, n) * n
+    tPABind[inner] = restrictBlock(patch.tPABind, n)
+    KMask = backend.getKMask(lattice, K)
+
+    return fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA
+
+# Clot front from the fine patch, in coarse lattice units
+def getPatchFrontIndex(patch):
+    return getFrontIndex(patch.K, patch.clot, patch.clotMask) / patch.factor
+
+############################## Patch Flux Check #####################################
+
+# Clot-free check of the patch : the same flow runs with and without the patch and
+# the flux through the clot section is compared, the walls of the patch should not
+# change it. Returns the relative flux deviation and whether it is within tolerance.
+def checkPatchFlux(backend, n, margin, fin, fout, F, bounceback, openPath, injection, clotMask,
+                   lattice, fluid, clot, tpa, d2q9, d2q4, steps, tolerance):
+    # Clot-free state without tPA
+    K = zeros((2,) + bounceback.shape)
+    KMask = backend.getKMask(lattice, K)
+    tPA = zeros((4,) + bounceback.shape)
+    args = (F, bounceback, openPath, injection, lattice, fluid, clot, tpa, d2q9, d2q4)
+
+    patch = initRefinement(backend, n, margin, fin, tPA, tPA, K, F, bounceback, injection, clotMask,
+                           lattice, fluid, clot, tpa, d2q9, d2q4)
+
+    # Independent copies so that neither run touches the caller's arrays
+    plain = tuple(copy(a) for a in (fin, fout, tPA, tPA, tPA, K, KMask))
+    refined = tuple(copy(a) for a in plain)
+
+    for _ in range(steps):
+        plain = thrombolysisStep(backend, *plain[:7], *args)
+        refined = refinedThrombolysisStep(backend, patch, *refined[:7], *args)
+
+    # Flux along x through the middle of the clot
+    rows, cols = where(clotMask)
+    section = ((rows.min() + rows.max()) // 2, slice(cols.min(), cols.max() + 1))
+    fluxes = []
+    for state in (plain, refined):
+        rho, u = backend.macroscopic(state[0], lattice, d2q9)
+        fluxes.append(sum(rho[section] * u[0][section]))
+
+    deviation = abs(fluxes[1] - fluxes[0]) / abs(fluxes[0])
+    passed = deviation <= tolerance
+
+    # Report
+    print("Patch flux check over " + str(steps) + " clot-free steps : without patch = " + str(fluxes[0])
+          + ", with patch = " + str(fluxes[1]))
+    print("  relative deviation = " + str(deviation) + " " + ("PASSED" if passed else "FAILED")
+          + " (tolerance = " + str(tolerance) + ")")
+
+    return deviation, passed
@@ -0,0 +1,104 @@
+from numpy import *
+from functionsMonitoring import getFrontIndex
+
+############################## Clot Diagnostics #####################################
+
+# Remaining clot resistance, as a fraction of the initial one
+def getRemainingResistance(K, clot, clotMask):
+    return sum(K[0,clotMask]) / (clot.K_initial[0] * count_nonzero(clotMask))
+
+# Check if at least one lane of the clot is fully dissolved along its length
+def isRecanalised(K, clotMask):
+    # get clot coordinates
+    rows, cols = where(clotMask)
+    row_start, row_end = rows.min(), rows.max() + 1
+    col_start, col_end = cols.min(), cols.max() + 1
+
+    # A lane is open when K is null everywhere along the clot length
+    openLanes = all(K[0,row_start:row_end, col_start:col_end] == 0, axis=0)
+
+    return bool(any(openLanes))
+
+############################## Stop Conditions & Events #############################
+
+# Initialising the stop monitor keeping track of the clot between checks
+def initStopMonitor():
+    class Monitor:
+        lastFront = None            # Last clot front index seen
+        lastFrontMove = None        # Iteration at which the front last moved (None before it first moves)
+        lastBound = None            # Last total of binded tPA on the clot
+        remainingIterations = []    # Iterations of the checks
+        remainingValues = []        # Remaining clot resistance at each check
+        milestonesReached = []      # Front milestones already fired
+        recanalised = False         # Recanalisation already fired
+        eventNames = []             # Fired events, in order
+        eventIterations = []        # Iteration of each fired event
+    return Monitor
+
+# Recording an event and calling the user callbacks registered for it
+def fireEvent(monitor, events, event, execTime, value):
+    monitor.eventNames.append(event + "=" + str(value))
+    monitor.eventIterations.append(execTime)
+    for callback in events.callbacks.get(event, []):
+        callback(event, execTime, value)
+
+# Evaluating the stop conditions and events, returns the stopping reason or None.
+# The clot front is computed from K unless given (e.g. from a refined patch)
+def checkStopConditions(monitor, K, tPABind, execTime, clot, clotMask, stop, events, frontIndex=None):
+    # Clot front and remaining resistance
+    if frontIndex is None:
+        frontIndex = getFrontIndex(K, clot, clotMask)
+    remaining = getRemainingResistance(K, clot, clotMask)
+
+    # Front milestones
+    for milestone in events.frontMilestones:
+        if frontIndex >= milestone and milestone not in monitor.milestonesReached:
+            monitor.milestonesReached.append(milestone)
+            fireEvent(monitor, events, "frontMilestone", execTime, milestone)
+
+    # Recanalisation through the clot
+    if not monitor.recanalised and isRecanalised(K, clotMask):
+        monitor.recanalised = True
+        fireEvent(monitor, events, "recanalisation", execTime, frontIndex)
+
+    # Front movement tracking, the stall clock only starts once the front moved.
+    # Traces of tPA reach the clot long before, so any drop of the remaining
+    # resistance is not a sign that the front is on its way.
+    if monitor.lastFront is not None and frontIndex != monitor.lastFront:
+        monitor.lastFrontMove = execTime
+    monitor.lastFront = frontIndex
+
+    # Remaining resistance tracking, and the last value at least progressWindow ago
+    monitor.remainingIterations.append(execTime)
+    monitor.remainingValues.append(remaining)
+    pastRemaining = None
+    if stop.progressWindow is not None:
+        for iteration, value in zip(monitor.remainingIterations, monitor.remainingValues):
+            if iteration > execTime - stop.progressWindow:
+                break
+            pastRemaining = value
+
+    # Binded tPA tracking
+    bound = sum(tPABind[:,clotMask])
+    lastBound = monitor.lastBound
+    monitor.lastBound = bound
+
+    # Stop conditions
+    reason = None
+    if stop.dissolved and remaining == 0:
+        reason = "dissolved"
+    elif stop.resistanceFraction is not None and remaining < stop.resistanceFraction:
+        reason = "resistance"
+    elif (stop.stallWindow is not None and monitor.lastFrontMove is not None
+          and execTime - monitor.lastFrontMove >= stop.stallWindow):
+        reason = "stalled"
+    elif pastRemaining is not None and pastRemaining - remaining < stop.progressTolerance:
+        reason = "noProgress"
+    elif (stop.saturationTolerance is not None and lastBound is not None and lastBound > 0
+          and abs(bound - lastBound) <= stop.saturationTolerance * lastBound):
+        reason = "saturated"
+
+    if reason is not None:
+        fireEvent(monitor, events, "stop", execTime, reason)
+
+    return reason
@@ -4,6 +4,11 @@
 from numpy import *
 from functionsLB import *
 from functionsMonitoring import *
+from functionsBackends import *
+from functionsStopping import *
+from functionsParallel import *
+from functionsRefinement import *
+from functionsProjective import *
 import time
 
 ####################################### Data Load & Save ###########################################
@@ -11,6 +16,54 @@ import time
 loadData = True
 saveData = False
 
+####################################### Compute Backend ############################################
+
+# Kernel implementation, resolved from the backend registry at startup
+class Backend:
+    name = "numpy"                  # "numpy" (reference) or "vectorised"
+    crossCheck = False              # Compare the backend with the numpy reference before running
+    crossCheckSteps = 100           # Number of steps run on both backends in cross-check mode
+    tolerance = 1e-10               # Max accepted field deviation in cross-check mode
+
+LB = getBackend(Backend.name)
+
+# Multi-process domain decomposition
+class Parallel:
+    processes = 1                   # Number of subdomains, each in its own process (1 = serial run)
+    gatherEvery = 50                # Cadence of clot state gathering, front saving and stop conditions
+                                    # (used instead of StopConditions.checkEvery)
+
+# Local grid refinement around the clot (serial run only)
+class Refinement:
+    enabled = False                 # Runs the clot region on a finer patch coupled to the lattice
+    factor = 3                      # Refinement factor of the patch (dx/factor, dt/factor), odd keeps the walls in place
+    margin = 4                      # Coarse nodes added around the clot in the patch (at least 1)
+    fluxCheck = False               # Compare the clot-free flux with and without the patch before running
+    fluxCheckSteps = 1000           # Number of clot-free steps run in flux check mode
+    fluxTolerance = 0.01            # Max accepted relative flux deviation in flux check mode
+
+# Projective integration of the clot dissolution (serial run only)
+class Projective:
+    enabled = False                 # Extrapolates the clot state between bursts of coupled steps
+    burstSteps = 60                 # Fully coupled steps per burst
+    healSteps = 30                  # First steps of a burst, left for the fluid and tPA to re-equilibrate
+    tolerance = 0.01                # Max relative extrapolation error on the clot totals per projection
+    rateTolerance = 1               # Max relative change of the clot totals rates over a projection
+    projectTPA = True               # Also projects the slow drift of free tPA (filling of the loop)
+    initialProjection = 200         # First projection step (iterations)
+    minProjection = 0               # Bounds of the adaptive projection step (iterations)
+    maxProjection = 5000
+    reference = None                # clotFront directory of a standard run to compare the clot front with
+
+if Refinement.enabled and Refinement.margin < 1:
+    raise ValueError("The refinement margin must be at least one coarse node")
+if Refinement.enabled and Parallel.processes > 1:
+    raise ValueError("Grid refinement is not supported with multiple processes")
+if Projective.enabled and (Parallel.processes > 1 or Refinement.enabled):
+    raise ValueError("Projective integration is only supported in the serial run without refinement")
+if Projective.enabled and not 0 < Projective.healSteps < Projective.burstSteps:
+    raise ValueError("Projective.healSteps must be strictly between 0 and Projective.burstSteps")
+
 ################################### Flow & Geometry Definition #####################################
 
 # Lattice goemetry definition
@@ -40,6 +93,23 @@ class TPA:
     rho_initial = 1                 # tPA concentration
     r = 0.8                         # tPA reaction proportion
 
+# Stop conditions, evaluated every checkEvery iterations (None = disabled). Parallel runs evaluate
+# them every Parallel.gatherEvery iterations, projective runs after every projection instead.
+class StopConditions:
+    checkEvery = 50                 # Evaluation cadence of the stop conditions and events
+    dissolved = True                # Stop when K is null everywhere in the clot
+    resistanceFraction = None       # Stop when the remaining clot resistance is below this fraction
+    stallWindow = None              # Stop when the clot front has not moved for this many iterations, once it started moving
+                                    # (longer than the time to dissolve one clot column)
+    progressWindow = None           # Stop when the remaining resistance dropped by less than progressTolerance over this many
+    progressTolerance = 0.01        # iterations (longer than the tPA arrival time), catches fronts that never move
+    saturationTolerance = None      # Stop when binded tPA changes less than this fraction between checks
+
+# Events fired during lysis, callbacks are called as callback(event, iteration, value)
+class Events:
+    frontMilestones = [5, 10, 15]   # Clot front positions firing a "frontMilestone" event
+    callbacks = {"frontMilestone": [], "recanalisation": [], "stop": []}
+
 ########################## Lattice Constants ###########################################
 
 class D2Q9:
@@ -74,7 +144,10 @@ clotMask = generateClotMask(Lattice, Clot)
 K = generateK(Lattice, Clot, clotMask)
 
 # Clot remaing values mask
-KMask = getKMask(Lattice, K)
+KMask = LB.getKMask(Lattice, K)
+
+# tPA injection site
+injection = generateInjectionMask(Lattice)
 
 # acceleration field for fluid aceleration in the lower left tube section
 accField = generateAccFieldMask(Lattice)
@@ -88,10 +161,18 @@ F[1,accField] = Fluid.F_initial[1]
 # Dictionnary to generate directories if needed to save data throughout execution
 class DirectoryGen:
     clotFront = True
+    tag = ""                        # Run mode, keeps decomposed and projective runs apart from the serial ones
+if Parallel.processes > 1: DirectoryGen.tag = "_np=" + str(Parallel.processes)
+if Projective.enabled: DirectoryGen.tag = "_projective"
 
 # Generating working directories
 Directories = createRepositoriesThrombolysis(Lattice, Fluid, Clot, TPA, DirectoryGen)
 
+# The reference clot front would be overwritten by the projective run
+if (Projective.enabled and Projective.reference is not None
+        and os.path.abspath(Projective.reference) == os.path.abspath(Directories.clotFront)):
+    raise ValueError("Projective.reference is the clotFront directory of this run : " + Directories.clotFront)
+
 # Defining geometry type
 if Lattice.branch:
     GeometryType = "branch=" + str(Lattice.branchSize) 
@@ -104,6 +185,11 @@ plotSystem(Directories.mainDir, Lattice, bounceback, openPath, clotMask, accFiel
 # Defining output variables
 clotFront = []
 iterations = []
+checkpointDiagnostics = []
+
+# Stop conditions and events monitoring
+StopMonitor = initStopMonitor()
+stopReason = "maxIter"
 
 ############################# System Initliaization #################################
 
@@ -114,112 +200,149 @@ vel = zeros((2,Lattice.nx, Lattice.ny))
 rho = full((Lattice.nx, Lattice.ny), Fluid.rho_initial)
 
 # initialization of the populations at equilibrium with the given density & velocity.
-fin = equilibrium(rho, vel, Lattice, D2Q9)
-fout = equilibrium(rho, vel, Lattice, D2Q9)
+fin = LB.equilibrium(rho, vel, Lattice, D2Q9)
+fout = LB.equilibrium(rho, vel, Lattice, D2Q9)
 
 # Loading already converged fluid (necessary for tPA injection)
 if loadData: fin, fout, _, u = getVariables(GeometryType, Lattice, Fluid, Clot, 100000)
 
 # tPA density initialization
 rhoTPA = zeros((Lattice.nx, Lattice.ny))
-rhoTPA[1:Lattice.tubeSize+1, Lattice.ny//2] = TPA.rho_initial
+rhoTPA[injection] = TPA.rho_initial
 
 # tPA population initialization
-tPAin = equilibriumTPA(rhoTPA, u, Lattice, D2Q4)
-tPAout = equilibriumTPA(rhoTPA, u, Lattice, D2Q4)
+tPAin = LB.equilibriumTPA(rhoTPA, u, Lattice, D2Q4)
+tPAout = LB.equilibriumTPA(rhoTPA, u, Lattice, D2Q4)
 
 # tPA binded initialization
 tPABind = zeros((4,Lattice.nx, Lattice.ny))
 
+# Checking the selected backend against the numpy reference
+if Backend.crossCheck:
+    _, passed = crossCheckBackends(getBackend("numpy"), LB, thrombolysisStep,
+                                   (fin, fout, tPAin, tPAout, tPABind, K, KMask),
+                                   (F, bounceback, openPath, injection, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4),
+                                   ["fin", "fout", "tPAin", "tPAout", "tPABind", "K", "KMask", "rho", "u", "rhoTPA"],
+                                   Backend.crossCheckSteps, Backend.tolerance)
+    if not passed:
+        raise RuntimeError("Backend '" + LB.name + "' failed the cross-check against numpy")
+
+# Fine patch around the clot
+if Refinement.enabled:
+    if Refinement.fluxCheck:
+        checkPatchFlux(LB, Refinement.factor, Refinement.margin, fin, fout, F, bounceback, openPath,
+                       injection, clotMask, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4,
+                       Refinement.fluxCheckSteps, Refinement.fluxTolerance)
+    Patch = initRefinement(LB, Refinement.factor, Refinement.margin, fin, tPAin, tPABind, K, F,
+                           bounceback, injection, clotMask, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4)
+
 ################################# Main time loop ######################################
 
 # Monitoring execution time
 start_time = time.time()
 
-# main loop
-for execTime in range(Lattice.maxIter):
+# Clot front saving and stop conditions, for the runs that only see the clot state periodically
+def onCheckpoint(execTime, K, tPABind, diagnostics):
+    clotFront.append(getFrontIndex(K, Clot, clotMask))
+    iterations.append(execTime)
+    checkpointDiagnostics.append(diagnostics)
+    print("iteration : " + str(execTime) + "/" + str(Lattice.maxIter), end="\r")
+    return checkStopConditions(StopMonitor, K, tPABind, execTime, Clot, clotMask, StopConditions, Events)
+
+# Decomposed run : the main process only handles the gathered clot state
+if Parallel.processes > 1:
 
-    # Compute macroscopic variables, density and velocity.
-    rho, u = macroscopic(fin, Lattice, D2Q9)            # fluid 
-    rhoTPA = macroscopicTPA(tPAin)                      # tPA 
+    fin, fout, tPAin, tPAout, tPABind, K, execTime, reason = runDecomposed(
+        Parallel.processes, LB, fin, fout, tPAin, tPAout, tPABind, K, F, bounceback, openPath,
+        injection, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4, Parallel.gatherEvery, onCheckpoint)
+    if reason is not None: stopReason = reason
 
-    # injecting tPA constantly
-    rhoTPA[1:Lattice.tubeSize+1, Lattice.ny//2] = Fluid.rho_initial
+    # Final macroscopic variables
+    rho, u = LB.macroscopic(fin, Lattice, D2Q9)
 
-    # Compute equilibrium.
-    feq = equilibrium(rho, u, Lattice, D2Q9)           # fluid
-    tPAeq = equilibriumTPA(rhoTPA, u, Lattice, D2Q4)   # tPA
+# Projective run : bursts of coupled steps and extrapolated clot state
+elif Projective.enabled:
 
-    # Fluid BGK collision step for open path
-    fout[:,openPath] = fin[:,openPath] - Fluid.omega * (fin[:,openPath] - feq[:,openPath])   
+    fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, execTime, reason = runProjective(
+        LB, fin, fout, tPAin, tPAout, tPABind, K, KMask, F, bounceback, openPath,
+        injection, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4, Projective, onCheckpoint)
+    if reason is not None: stopReason = reason
 
-    # tPA BGK collision : only where there is no K
-    openPathNoK = where(KMask==False, openPath, False)
-    tPAout[:,openPathNoK] = tPAin[:,openPathNoK] - Fluid.omega * (tPAin[:,openPathNoK] - tPAeq[:,openPathNoK])    # tPA
-    
-    # Bounce-back condition 
-    for i in range(9):                                  # fluid
-        fout[i, bounceback] = fin[8-i, bounceback]
-    for i in range(4):                                  # tPA
-        tPAout[i, bounceback] = tPAin[3-i, bounceback]
-    for i in range(4):                                  # Partial tPA bounceback on clot nodes
-        tPAout[i, KMask] = tPAin[3-i, KMask]
-
-    # Forces (acceleration and clot resistance) application
-    fout += addForces(rho, u, F, K, Lattice, D2Q9)
-    
-    # Streaming step for fluid in every direction i=0:8
-    fin[0,:,:] = roll(roll(fout[0,:,:],1,axis=0),1,axis=1)      # i = 0
-    fin[1,:,:] = roll(fout[1,:,:],1,axis=0)                     # i = 1
-    fin[2,:,:] = roll(roll(fout[2,:,:],1,axis=0),-1,axis=1)     # i = 2
-    fin[3,:,:] = roll(fout[3,:,:],1,axis=1)                     # i = 3
-    fin[4,:,:] = fout[4,:,:]                                    # i = 4
-    fin[5,:,:] = roll(fout[5,:,:],-1,axis=1)                    # i = 5
-    fin[6,:,:] = roll(roll(fout[6,:,:],-1,axis=0),1,axis=1)     # i = 6
-    fin[7,:,:] = roll(fout[7,:,:],-1,axis=0)                    # i = 7
-    fin[8,:,:] = roll(roll(fout[8,:,:],-1,axis=0),-1,axis=1)    # i = 8
-
-    # Streaming step for tPA in every direction i=0:4
-    tPAin[0,:,:] = roll(tPAout[0,:,:],1,axis=0)                 # i = 0
-    tPAin[1,:,:] = roll(tPAout[1,:,:],1,axis=1)                 # i = 1
-    tPAin[2,:,:] = roll(tPAout[2,:,:],-1,axis=1)                # i = 2
-    tPAin[3,:,:] = roll(tPAout[3,:,:],-1,axis=0)                # i = 3
-
-    # Bind tPA to clot fribrin
-    tPABind, tPAin = bindTPA(Clot, tPAin, tPABind, KMask)
-
-    # Dissolve clot
-    K, tPABind = dissolveClot(tPABind, K, TPA)
-
-    # print(KMask.shape)
-    KMask = getKMask(Lattice, K)
-
-    # liberate remaining binded tPA for empty sites
-    tPABind = liberateTPA(tPABind, KMask)
-
-    # Saving clot front coordinate evolution
-    if(execTime%50==0):
-        frontIndex = getFrontIndex(K, Clot, clotMask)
-        clotFront.append(frontIndex)
-        iterations.append(execTime)
-
-    # Visualization of tPA density
-    if (execTime%10==0):
-        visualiseTPADensity(rhoTPA)
-
-    # Displaying current progress
-    print("iteration : " + str(execTime) + "/" + str(Lattice.maxIter), end="\r")
+# Serial run
+else:
+
+    # main loop
+    for execTime in range(Lattice.maxIter):
+
+        # Coupled fluid, tPA and clot update, with the clot region on the fine patch if refined
+        if Refinement.enabled:
+            fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA = refinedThrombolysisStep(
+                LB, Patch, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                F, bounceback, openPath, injection, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4)
+        else:
+            fin, fout, tPAin, tPAout, tPABind, K, KMask, rho, u, rhoTPA = thrombolysisStep(
+                LB, fin, fout, tPAin, tPAout, tPABind, K, KMask,
+                F, bounceback, openPath, injection, Lattice, Fluid, Clot, TPA, D2Q9, D2Q4)
+
+        # Saving clot front coordinate evolution (fine resolution if refined)
+        if(execTime%50==0):
+            if Refinement.enabled:
+                frontIndex = getPatchFrontIndex(Patch)
+            else:
+                frontIndex = getFrontIndex(K, Clot, clotMask)
+            clotFront.append(frontIndex)
+            iterations.append(execTime)
+
+        # Evaluating stop conditions and events, on the fine clot front if refined
+        if (execTime%StopConditions.checkEvery==0):
+            frontIndex = getPatchFrontIndex(Patch) if Refinement.enabled else None
+            reason = checkStopConditions(StopMonitor, K, tPABind, execTime, Clot, clotMask,
+                                         StopConditions, Events, frontIndex)
+            if reason is not None:
+                stopReason = reason
+                break
+
+        # Visualization of tPA density
+        if (execTime%10==0):
+            visualiseTPADensity(rhoTPA)
+
+        # Displaying current progress
+        print("iteration : " + str(execTime) + "/" + str(Lattice.maxIter), end="\r")
     
 
 # Final execution time
 end_time = time.time()
 print("Execution time : " + str(end_time-start_time) + " [s]")
+if stopReason == "maxIter": fireEvent(StopMonitor, Events, "stop", execTime, stopReason)
+print("Stopped at iteration " + str(execTime) + " : " + stopReason)
 
 ######################## Final Iteration Monitoring ########################## 
 
 saveValues(Directories.clotFront, '/clotFront.csv',
             'it', 'pos', clotFront, iterations)
 
+# Clot front agreement of the projective run with a standard run
+if Projective.enabled and Projective.reference is not None:
+    refIterations, refFront = loadValues(Projective.reference, '/clotFront.csv')
+    devIterations, deviation = compareClotFronts(iterations, clotFront, refIterations, refFront)
+    saveValues(Directories.clotFront, '/clotFrontDeviation.csv',
+                'it', 'dpos', deviation, devIterations)
+
+# Checkpoint diagnostics, one file per quantity : reductions of the decomposed run,
+# projection steps of the projective run
+diagnosticNames = []
+if Parallel.processes > 1:
+    diagnosticNames = ['fluidMass', 'freeTPA', 'remainingK', 'bindedTPA']
+elif Projective.enabled:
+    diagnosticNames = ['projectionStep', 'computedSteps']
+for column, name in enumerate(diagnosticNames):
+    saveValues(Directories.mainDir, '/' + name + '.csv', 'it', name,
+                [values[column] for values in checkpointDiagnostics], iterations)
+
+# Fired events, the last one being the stopping reason and iteration
+saveValues(Directories.mainDir, '/events.csv', 'it', 'event',
+            StopMonitor.eventNames, StopMonitor.eventIterations)
+
 
 ########################### Converged System Saving ############################# 
 
@@ -4,6 +4,7 @@
 from numpy import *
 from functionsLB import *
 from functionsMonitoring import *
+from functionsBackends import *
 import time
 
 ####################################### Data Load & Save ###########################################
@@ -11,6 +12,17 @@ import time
 loadData = False
 saveData = True
 
+####################################### Compute Backend ############################################
+
+# Kernel implementation, resolved from the backend registry at startup
+class Backend:
+    name = "numpy"                  # "numpy" (reference) or "vectorised"
+    crossCheck = False              # Compare the backend with the numpy reference before running
+    crossCheckSteps = 100           # Number of steps run on both backends in cross-check mode
+    tolerance = 1e-10               # Max accepted field deviation in cross-check mode
+
+LB = getBackend(Backend.name)
+
 ################################### Flow & Geometry Definition #####################################
 
 # Lattice goemetry definition
@@ -60,7 +72,7 @@ clotMask = generateClotMask(Lattice, Clot)
 K = generateK(Lattice, Clot, clotMask)
 
 # Clot remaing values mask
-KMask = getKMask(Lattice, K)
+KMask = LB.getKMask(Lattice, K)
 
 # acceleration field for fluid aceleration in the lower left tube section
 accField = generateAccFieldMask(Lattice)
@@ -93,12 +105,21 @@ vel = zeros((2,Lattice.nx, Lattice.ny))
 rho = full((Lattice.nx, Lattice.ny), Fluid.rho_initial)
 
 # initialization of the populations at equilibrium with the given density & velocity.
-fin = equilibrium(rho, vel, Lattice, D2Q9)
-fout = equilibrium(rho, vel, Lattice, D2Q9)
+fin = LB.equilibrium(rho, vel, Lattice, D2Q9)
+fout = LB.equilibrium(rho, vel, Lattice, D2Q9)
 
 # Loading already converged variables for faster execution time
 if loadData: fin, fout, _, u = getVariables(GeometryType, Lattice, Fluid, Clot, 100000)
 
+# Checking the selected backend against the numpy reference
+if Backend.crossCheck:
+    _, passed = crossCheckBackends(getBackend("numpy"), LB, fluidStep,
+                                   (fin, fout), (K, F, bounceback, openPath, Lattice, Fluid, D2Q9),
+                                   ["fin", "fout", "rho", "u"],
+                                   Backend.crossCheckSteps, Backend.tolerance)
+    if not passed:
+        raise RuntimeError("Backend '" + LB.name + "' failed the cross-check against numpy")
+
 ################################# Main time loop ######################################
 
 # Monitoring execution time
@@ -107,32 +128,8 @@ start_time = time.time()
 # main loop
 for execTime in range(Lattice.maxIter):
 
-    # Compute macroscopic variables density and velocity.
-    rho, u = macroscopic(fin, Lattice, D2Q9)
-
-    # Compute equilibrium.
-    feq = equilibrium(rho, u, Lattice, D2Q9)
-
-    # Fluid BGK collision step for open path
-    fout[:,openPath] = fin[:,openPath] - Fluid.omega * (fin[:,openPath] - feq[:,openPath])    
-    
-    # Bounce-back condition 
-    for i in range(9):                                  
-        fout[i, bounceback] = fin[8-i, bounceback]
-
-    # Forces (acceleration and clot resistance) application
-    fout += addForces(rho, u, F, K, Lattice, D2Q9)
-    
-    # Streaming step for fluid in every direction i=0:8
-    fin[0,:,:] = roll(roll(fout[0,:,:],1,axis=0),1,axis=1)      # i = 0
-    fin[1,:,:] = roll(fout[1,:,:],1,axis=0)                     # i = 1
-    fin[2,:,:] = roll(roll(fout[2,:,:],1,axis=0),-1,axis=1)     # i = 2
-    fin[3,:,:] = roll(fout[3,:,:],1,axis=1)                     # i = 3
-    fin[4,:,:] = fout[4,:,:]                                    # i = 4
-    fin[5,:,:] = roll(fout[5,:,:],-1,axis=1)                    # i = 5
-    fin[6,:,:] = roll(roll(fout[6,:,:],-1,axis=0),1,axis=1)     # i = 6
-    fin[7,:,:] = roll(fout[7,:,:],-1,axis=0)                    # i = 7
-    fin[8,:,:] = roll(roll(fout[8,:,:],-1,axis=0),-1,axis=1)    # i = 8
+    # Fluid update
+    fin, fout, rho, u = fluidStep(LB, fin, fout, K, F, bounceback, openPath, Lattice, Fluid, D2Q9)
 
     # Visualization of the velocity.
     if (execTime%10==0):